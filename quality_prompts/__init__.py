@@ -1,3 +1,5 @@
-from .prompt import QualityPrompt
-from .exemplars import ExemplarStore, Exemplar
+from .prompt import QualityPrompt, PromptTokenSplit
+from .exemplars import ExemplarStore, Exemplar, DeduplicationReport
+from .shared_exemplars import SharedExemplarStore, SharedExemplarStorePublisher
 from .utils.llm import *
+from .router import TechniqueRouter, TechniqueChain, TechniqueProfile
@@ -5,6 +5,8 @@ import numpy as np
 
 from .utils.llm import get_embedding
 
+COMPLEXITY_LEVEL_RANKS = {"low": 0, "medium": 1, "high": 2}
+
 
 class Exemplar(BaseModel):
     input: str
@@ -17,20 +19,139 @@ class Exemplar(BaseModel):
         Output: {self.label}"""
 
 
+class DeduplicationReport(BaseModel):
+    original_size: int
+    deduplicated_size: int
+    n_clusters_merged: int
+
+    @property
+    def n_removed(self):
+        return self.original_size - self.deduplicated_size
+
+
 class ExemplarStore(BaseModel):
     exemplars: List[Exemplar]
 
     def size(self):
         return len(self.exemplars)
 
+    def deduplicate(self, threshold=0.95, block_size=1024):
+        """
+        Removes near-duplicate exemplars, keeping one representative per cluster.
+        Exemplars are visited from highest to lowest complexity_level (earliest on ties). Each one
+        joins its most similar representative if their cosine similarity is >= threshold, and otherwise
+        becomes a representative itself. So every removed exemplar is within threshold of the kept
+        exemplar it was merged into, and is no more complex than it.
+        Similarities are computed block by block, so memory stays O(block_size * n_representatives).
+        """
+        original_size = self.size()
+        if original_size < 2:
+            return DeduplicationReport(
+                original_size=original_size,
+                deduplicated_size=original_size,
+                n_clusters_merged=0,
+            )
+
+        embeddings = np.array(
+            [example.input_embedding for example in self.exemplars], dtype=np.float32
+        )
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        norms[norms == 0] = 1.0
+        embeddings /= norms
+
+        visiting_order = sorted(
+            range(original_size),
+            key=lambda i: (
+                -COMPLEXITY_LEVEL_RANKS.get(self.exemplars[i].complexity_level, 0),
+                i,
+            ),
+        )
+        representatives = []
+        merged_representatives = set()
+
+        for block_start in range(0, original_size, block_size):
+            block = visiting_order[block_start : block_start + block_size]
+            block_embeddings = embeddings[block]
+            previous_representatives = list(representatives)
+            previous_similarities = (
+                block_embeddings @ embeddings[previous_representatives].T
+            )
+
+            block_representatives = []  # Positions within the block
+            for position, i in enumerate(block):
+                similarities = previous_similarities[position]
+                if block_representatives:
+                    similarities = np.concatenate(
+                        (
+                            similarities,
+                            block_embeddings[block_representatives]
+                            @ block_embeddings[position],
+                        )
+                    )
+                if similarities.size and similarities.max() >= threshold:
+                    candidates = previous_representatives + [
+                        block[p] for p in block_representatives
+                    ]
+                    merged_representatives.add(candidates[int(np.argmax(similarities))])
+                else:
+                    block_representatives.append(position)
+                    representatives.append(i)
+
+        self.exemplars = [self.exemplars[i] for i in sorted(representatives)]
+        return DeduplicationReport(
+            original_size=original_size,
+            deduplicated_size=self.size(),
+            n_clusters_merged=len(merged_representatives),
+        )
+
+    def estimate_complexity(self, input_text, k=5, input_embedding=None):
+        """
+        Scores how difficult the input is likely to be, between 0 and 1, as the
+        similarity-weighted mean complexity_level of its k nearest exemplars.
+        input_embedding: embedding of input_text, if already computed.
+        """
+        if self.size() == 0:
+            return 0.0
+        if input_embedding is None:
+            input_embedding = get_embedding(input_text)
+        input_embedding = np.array(input_embedding).reshape(1, -1)
+        example_embeddings = np.array(
+            [example.input_embedding for example in self.exemplars]
+        )
+
+        nbrs = NearestNeighbors(n_neighbors=min(k, self.size()), metric="cosine")
+        nbrs.fit(example_embeddings)
+        distances, indices = nbrs.kneighbors(input_embedding)
+
+        max_rank = max(COMPLEXITY_LEVEL_RANKS.values())
+        complexities = np.array(
+            [
+                COMPLEXITY_LEVEL_RANKS.get(self.exemplars[i].complexity_level, 0)
+                / max_rank
+                for i in indices.flatten()
+            ]
+        )
+        weights = np.clip(1 - distances.flatten(), 0, None)
+        if weights.sum() == 0:
+            return float(complexities.mean())
+        return float(np.average(complexities, weights=weights))
+
     def get_similar_exemplars_to_test_sample(
         self,
         input_text,
         exemplar_selection_method="knn",
         k=3,
         prioritise_complex_exemplars=False,
+        diversity=0.0,
+        input_embedding=None,
     ):
-        input_embedding = get_embedding(input_text)
+        """
+        diversity: between 0 and 1. If above 0, the top k exemplars are re-ranked with
+        maximal marginal relevance (MMR) so that near-identical exemplars aren't all returned.
+        input_embedding: embedding of input_text, if already computed.
+        """
+        if input_embedding is None:
+            input_embedding = get_embedding(input_text)
         input_embedding = np.array(input_embedding).reshape(1, -1)
 
         # Extract embeddings of all exemplars
@@ -84,16 +205,57 @@ class ExemplarStore(BaseModel):
             if example_embeddings.size == 0:
                 raise ValueError("No exemplars found for KNN search.")
 
+            # Fetch a larger candidate pool when re-ranking for diversity
+            n_candidates = k
+            if diversity > 0:
+                n_candidates = min(len(exemplars_to_search), k * 4)
+
             # Initialize and fit the NearestNeighbors model
-            nbrs = NearestNeighbors(n_neighbors=k, metric="cosine")
+            nbrs = NearestNeighbors(n_neighbors=n_candidates, metric="cosine")
             nbrs.fit(example_embeddings)
             distances, indices = nbrs.kneighbors(input_embedding)
+            indices = indices.flatten()
+
+            if diversity > 0:
+                indices = maximal_marginal_relevance(
+                    candidate_embeddings=example_embeddings[indices],
+                    query_similarities=1 - distances.flatten(),
+                    k=k,
+                    diversity=diversity,
+                    candidate_indices=indices,
+                )
 
             # Return the top k closest exemplars
-            return [exemplars_to_search[i] for i in indices.flatten()]
+            return [exemplars_to_search[i] for i in indices]
 
         elif exemplar_selection_method == "vote-k":
             pass  # TODO
 
         elif exemplar_selection_method == "sg-icl":
             pass  # TODO
+
+
+def maximal_marginal_relevance(
+    candidate_embeddings, query_similarities, k, diversity, candidate_indices
+):
+    """
+    Greedily picks k candidates, trading off similarity to the query against
+    similarity to the candidates already picked.
+    https://www.cs.cmu.edu/~jgc/publication/The_Use_MMR_Diversity_Based_LTMIR_1998.pdf
+    """
+    norms = np.linalg.norm(candidate_embeddings, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    normalised_embeddings = candidate_embeddings / norms
+    pairwise_similarities = normalised_embeddings @ normalised_embeddings.T
+
+    selected = [int(np.argmax(query_similarities))]
+    remaining = [i for i in range(len(candidate_indices)) if i != selected[0]]
+    while remaining and len(selected) < k:
+        redundancy = pairwise_similarities[np.ix_(remaining, selected)].max(axis=1)
+        relevance = query_similarities[remaining]
+        scores = (1 - diversity) * relevance - diversity * redundancy
+        best = remaining[int(np.argmax(scores))]
+        selected.append(best)
+        remaining.remove(best)
+
+    return [candidate_indices[i] for i in selected]
@@ -1,14 +1,30 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, PrivateAttr
 import warnings
-from typing import List
+from typing import List, Union
 import json
 
 from .exemplars import ExemplarStore, Exemplar
-from .utils.llm import llm_call, llm_call_multiple_choices, get_embedding
+from .shared_exemplars import SharedExemplarStore
+from .utils.llm import (
+    llm_call,
+    llm_call_multiple_choices,
+    get_embedding,
+    count_tokens,
+)
 from .utils.prompting_techniques_system_prompts import *
 from .utils.prompt_postprocessing import *
 
 
+class PromptTokenSplit(BaseModel):
+    static_tokens: int
+    dynamic_tokens: int
+
+    @property
+    def static_fraction(self):
+        total_tokens = self.static_tokens + self.dynamic_tokens
+        return self.static_tokens / total_tokens if total_tokens else 0.0
+
+
 class QualityPrompt(BaseModel):
     directive: str  # Core intent of the prompt
     output_formatting: str = ""
@@ -16,30 +32,102 @@ class QualityPrompt(BaseModel):
     style_instructions: str = ""
     role_instructions: str = ""
     emotion_instructions: str = ""
-    exemplar_store: ExemplarStore = ExemplarStore(exemplars=[])
+    exemplar_store: Union[ExemplarStore, SharedExemplarStore] = ExemplarStore(
+        exemplars=[]
+    )
     few_shot_examples: List[Exemplar] = []
+    # Normalised static parts of the prompt, keyed by the fields they're built from
+    _static_parts_cache: tuple = PrivateAttr(default=(None, None))
+
+    def _static_parts(self):
+        """
+        Normalises the parts of the prompt which don't change between requests,
+        only redoing it when the directive, additional information or output formatting change.
+        """
+        key = (self.directive, self.additional_information, self.output_formatting)
+        cached_key, static_parts = self._static_parts_cache
+        if cached_key != key:
+            static_parts = {
+                "prefix": remove_leading_whitespace(
+                    f"{self.directive}\n{self.additional_information}"
+                ),
+                "output_formatting": remove_leading_whitespace(self.output_formatting),
+                "token_counts": {},
+            }
+            static_parts["system_prompt"] = collapse_new_lines(
+                f"{static_parts['prefix']}\n{static_parts['output_formatting']}\n"
+            )
+            self._static_parts_cache = (key, static_parts)
+        return static_parts
 
     def compile(self):
+        static_parts = self._static_parts()
         formatted_examples = "\n".join(
             [
                 f"Example input: {e.input}\nExample output: {e.label}\n"
                 for e in self.few_shot_examples
             ]
         )
-        compiled_prompt = f"""{self.directive}
-        {self.additional_information}
-        {formatted_examples}
-        {self.output_formatting}
+        compiled_prompt = f"""{static_parts['prefix']}
+{remove_leading_whitespace(formatted_examples)}
+{static_parts['output_formatting']}
+"""
+        return collapse_new_lines(compiled_prompt)
+
+    def compile_messages(self, input_text=None):
+        """
+        Lays out the prompt as messages with all content that's invariant across requests first,
+        so providers' prompt prefix caches can be reused. Few-shot examples follow as
+        user / assistant turns, then the user's input.
+        """
+        messages = [
+            {"role": "system", "content": self._static_parts()["system_prompt"]}
+        ]
+        for e in self.few_shot_examples:
+            messages += [
+                {"role": "user", "content": e.input},
+                {"role": "assistant", "content": e.label},
+            ]
+        if input_text is not None:
+            messages.append({"role": "user", "content": input_text})
+        return messages
+
+    def token_split(self, input_text=None, model="gpt-3.5-turbo"):
+        """
+        Counts the tokens in the static (cacheable) and dynamic parts of compile_messages().
         """
-        return remove_extra_chars(compiled_prompt)
+        static_parts = self._static_parts()
+        token_counts = static_parts["token_counts"]
+        if model not in token_counts:
+            token_counts[model] = count_tokens(
+                static_parts["system_prompt"], model=model
+            )
+
+        dynamic_messages = self.compile_messages(input_text=input_text)[1:]
+        dynamic_tokens = sum(
+            count_tokens(message["content"], model=model)
+            for message in dynamic_messages
+        )
+        return PromptTokenSplit(
+            static_tokens=token_counts[model], dynamic_tokens=dynamic_tokens
+        )
 
-    def few_shot(self, input_text, n_shots=3, prioritise_complex_exemplars=False):
-        if len(self.exemplar_store.exemplars) > n_shots:
+    def few_shot(
+        self,
+        input_text,
+        n_shots=3,
+        prioritise_complex_exemplars=False,
+        diversity=0.0,
+        input_embedding=None,
+    ):
+        if self.exemplar_store.size() > n_shots:
             self.few_shot_examples = (
                 self.exemplar_store.get_similar_exemplars_to_test_sample(
                     input_text=input_text,
                     k=n_shots,
                     prioritise_complex_exemplars=prioritise_complex_exemplars,
+                    diversity=diversity,
+                    input_embedding=input_embedding,
                 )
             )
         else:
@@ -123,6 +211,9 @@ class QualityPrompt(BaseModel):
         https://arxiv.org/pdf/2201.11903
         """
         chain_of_thought_system_prompt = ChainOfThoughtSystemPrompt().system_prompt
+        # Only added once, so reusing the prompt keeps the cacheable prefix stable
+        if chain_of_thought_system_prompt in self.output_formatting:
+            return
         self.output_formatting = f"""{chain_of_thought_system_prompt}
         {self.output_formatting}"""
 
@@ -223,7 +314,7 @@ class QualityPrompt(BaseModel):
         self.few_shot_examples = [exemplar]
 
     def uncertainty_routed_cot_prompting(
-        self, input_text, n_reasoning_paths=5, temperature=0.4
+        self, input_text, n_reasoning_paths=5, temperature=0.4, input_embedding=None
     ):
         """
         Samples multiple CoT reasoning paths, then selects the majority if it is above a certain threshold (calculated based on validation data). If not, it samples greedily and selects that response
@@ -231,11 +322,7 @@ class QualityPrompt(BaseModel):
         """
         # Step 1: Generate n reasoning paths using an LLM
         self.chain_of_thought_prompting()
-        prompt_with_cot = self.compile()
-        messages = [
-            {"role": "system", "content": prompt_with_cot},
-            {"role": "user", "content": input_text},
-        ]
+        messages = self.compile_messages(input_text=input_text)
         cot_reasoning_paths = llm_call_multiple_choices(
             messages=messages, n=n_reasoning_paths, temperature=temperature
         )
@@ -252,15 +339,22 @@ class QualityPrompt(BaseModel):
         majority_reasoning_path = llm_call(
             messages=search_majority_reasoning_path_messages
         )
+        if input_embedding is None:
+            input_embedding = get_embedding(input_text)
         exemplar = Exemplar(
             input=input_text,
             label=majority_reasoning_path,
-            input_embedding=get_embedding(input_text),
+            input_embedding=input_embedding,
         )
         self.few_shot_examples = [exemplar]
 
     def complexity_based_prompting(
-        self, input_text, n_reasoning_paths=5, temperature=0.4, n_exemplars=3
+        self,
+        input_text,
+        n_reasoning_paths=5,
+        temperature=0.4,
+        n_exemplars=3,
+        input_embedding=None,
     ):
         """
         First searches the most complex exemplars for use in context.
@@ -272,14 +366,11 @@ class QualityPrompt(BaseModel):
             input_text=input_text,
             n_shots=n_exemplars,
             prioritise_complex_exemplars=True,
+            input_embedding=input_embedding,
         )
         # Step 2: Generate n reasoning paths using an LLM
         self.chain_of_thought_prompting()
-        prompt_with_cot = self.compile()
-        messages = [
-            {"role": "system", "content": prompt_with_cot},
-            {"role": "user", "content": input_text},
-        ]
+        messages = self.compile_messages(input_text=input_text)
         cot_reasoning_paths = llm_call_multiple_choices(
             messages=messages, n=n_reasoning_paths, temperature=temperature
         )
@@ -296,10 +387,12 @@ class QualityPrompt(BaseModel):
         majority_reasoning_path = llm_call(
             messages=search_majority_reasoning_path_messages
         )
+        if input_embedding is None:
+            input_embedding = get_embedding(input_text)
         exemplar = Exemplar(
             input=input_text,
             label=majority_reasoning_path,
-            input_embedding=get_embedding(input_text),
+            input_embedding=input_embedding,
         )
         self.few_shot_examples = [exemplar]
 
@@ -312,5 +405,7 @@ class QualityPrompt(BaseModel):
         constrained_chain_of_thought_system_prompt = (
             ConstrainedChainOfThoughtSystemPrompt(max_words=max_words).system_prompt
         )
+        if constrained_chain_of_thought_system_prompt in self.output_formatting:
+            return
         self.output_formatting = f"""{constrained_chain_of_thought_system_prompt}
         {self.output_formatting}"""
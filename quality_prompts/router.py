@@ -0,0 +1,186 @@
+from pydantic import BaseModel
+from typing import Dict, List, Optional
+import inspect
+import time
+
+from .prompt import QualityPrompt
+from .utils.llm import get_embedding, track_usage
+
+
+class TechniqueProfile(BaseModel):
+    """
+    Rolling (exponentially weighted) cost of running one prompting technique.
+    """
+
+    n_runs: int = 0
+    latency_seconds: float = 0.0
+    total_tokens: float = 0.0
+    llm_calls: float = 0.0
+
+    def update(self, latency_seconds, total_tokens, llm_calls, smoothing=0.2):
+        if self.n_runs == 0:
+            self.latency_seconds = latency_seconds
+            self.total_tokens = total_tokens
+            self.llm_calls = llm_calls
+        else:
+            self.latency_seconds += smoothing * (latency_seconds - self.latency_seconds)
+            self.total_tokens += smoothing * (total_tokens - self.total_tokens)
+            self.llm_calls += smoothing * (llm_calls - self.llm_calls)
+        self.n_runs += 1
+
+
+class TechniqueChain(BaseModel):
+    name: str
+    techniques: List[str]  # Names of QualityPrompt methods, applied in order
+    min_complexity: float = 0.0  # Only worth using for inputs at least this complex
+    # Rough cost of the whole chain, used until all its techniques have been measured
+    prior: Optional[TechniqueProfile] = None
+
+
+class TechniqueRouter(BaseModel):
+    """
+    Picks the strongest technique chain that fits a latency / token budget,
+    using the measured cost of each technique and the complexity of the input.
+    `chains` are ordered from cheapest / weakest to most expensive / strongest.
+    """
+
+    chains: List[TechniqueChain] = [
+        TechniqueChain(
+            name="cot",
+            techniques=["chain_of_thought_prompting"],
+            prior=TechniqueProfile(),
+        ),
+        TechniqueChain(
+            name="few_shot_cot",
+            techniques=["few_shot", "chain_of_thought_prompting"],
+            min_complexity=0.3,
+            # One embedding call
+            prior=TechniqueProfile(latency_seconds=0.5, total_tokens=50, llm_calls=1),
+        ),
+        TechniqueChain(
+            name="complexity_based",
+            techniques=["complexity_based_prompting"],
+            min_complexity=0.6,
+            # An embedding, 5 sampled reasoning paths and a majority-voting call
+            prior=TechniqueProfile(latency_seconds=8.0, total_tokens=4000, llm_calls=3),
+        ),
+    ]
+    profiles: Dict[str, TechniqueProfile] = {}
+    smoothing: float = 0.2
+    complexity_neighbours: int = 5
+
+    def estimated_cost(self, chain: TechniqueChain) -> Optional[TechniqueProfile]:
+        """
+        Sums the measured cost of the chain's techniques. If any of them hasn't been
+        measured yet, falls back to the chain's prior, which may be None.
+        """
+        estimate = TechniqueProfile()
+        for technique in chain.techniques:
+            profile = self.profiles.get(technique)
+            if profile is None or profile.n_runs == 0:
+                return chain.prior
+            estimate.latency_seconds += profile.latency_seconds
+            estimate.total_tokens += profile.total_tokens
+            estimate.llm_calls += profile.llm_calls
+        return estimate
+
+    def select_chain(
+        self,
+        complexity: float,
+        latency_budget: Optional[float] = None,
+        token_budget: Optional[float] = None,
+    ) -> TechniqueChain:
+        """
+        The first chain is the fallback. Chains are costed by their measured techniques,
+        or by their prior until those have been measured. A chain with neither is only
+        picked for requests without a budget, so it gets profiled.
+        """
+        selected_chain = self.chains[0]
+        has_budget = latency_budget is not None or token_budget is not None
+        for chain in self.chains[1:]:
+            if complexity < chain.min_complexity:
+                continue
+            estimate = self.estimated_cost(chain)
+            if estimate is None:
+                if has_budget:
+                    continue
+                selected_chain = chain
+                continue
+            if latency_budget is not None and estimate.latency_seconds > latency_budget:
+                continue
+            if token_budget is not None and estimate.total_tokens > token_budget:
+                continue
+            selected_chain = chain
+        return selected_chain
+
+    def run_technique(
+        self,
+        prompt: QualityPrompt,
+        technique: str,
+        input_text,
+        input_embedding=None,
+        **kwargs,
+    ):
+        """
+        Applies one technique to the prompt and records its latency and token usage.
+        """
+        method = getattr(prompt, technique)
+        parameters = inspect.signature(method).parameters
+        if "input_text" in parameters:
+            kwargs["input_text"] = input_text
+        if input_embedding is not None and "input_embedding" in parameters:
+            kwargs["input_embedding"] = input_embedding
+
+        start_time = time.perf_counter()
+        with track_usage() as usage:
+            method(**kwargs)
+        latency_seconds = time.perf_counter() - start_time
+
+        self.profiles.setdefault(technique, TechniqueProfile()).update(
+            latency_seconds=latency_seconds,
+            total_tokens=float(usage.total_tokens),
+            llm_calls=float(usage.llm_calls),
+            smoothing=self.smoothing,
+        )
+
+    def route(
+        self,
+        prompt: QualityPrompt,
+        input_text,
+        latency_budget: Optional[float] = None,
+        token_budget: Optional[float] = None,
+        complexity: Optional[float] = None,
+    ) -> TechniqueChain:
+        """
+        Applies the selected technique chain to the prompt and returns it.
+        If complexity isn't given, it's estimated from the prompt's exemplar store.
+        The input's embedding is computed once, counted against the budget, and reused
+        by the techniques that need it.
+        """
+        input_embedding = None
+        if complexity is None:
+            complexity = 0.0
+            if prompt.exemplar_store.size() > 0:
+                start_time = time.perf_counter()
+                with track_usage() as usage:
+                    input_embedding = get_embedding(input_text)
+                complexity = prompt.exemplar_store.estimate_complexity(
+                    input_text,
+                    k=self.complexity_neighbours,
+                    input_embedding=input_embedding,
+                )
+                if latency_budget is not None:
+                    latency_budget -= time.perf_counter() - start_time
+                if token_budget is not None:
+                    token_budget -= usage.total_tokens
+
+        chain = self.select_chain(
+            complexity=complexity,
+            latency_budget=latency_budget,
+            token_budget=token_budget,
+        )
+        for technique in chain.techniques:
+            self.run_technique(
+                prompt, technique, input_text, input_embedding=input_embedding
+            )
+        return chain
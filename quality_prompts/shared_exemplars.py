@@ -0,0 +1,415 @@
+from pydantic import BaseModel, PrivateAttr
+from multiprocessing import resource_tracker, shared_memory
+import sys
+import numpy as np
+
+from .exemplars import (
+    Exemplar,
+    ExemplarStore,
+    COMPLEXITY_LEVEL_RANKS,
+    maximal_marginal_relevance,
+)
+from .utils.llm import get_embedding
+
+# Segment layout: int64 header [n_exemplars, embedding_dim, text_nbytes, unused],
+# float32 embeddings (n x dim), float32 embedding norms (n), int8 complexity ranks (n),
+# int64 text offsets (2n + 1), utf-8 text with each exemplar's input then label.
+_HEADER_SIZE = 4
+# Stored for complexity levels other than low / medium / high
+_UNKNOWN_COMPLEXITY_RANK = -1
+# Segments created by publishers in this process, which stay registered with the resource tracker
+_published_segment_names = set()
+_COMPLEXITY_LEVELS_BY_RANK = {
+    rank: level for level, rank in COMPLEXITY_LEVEL_RANKS.items()
+}
+
+
+def _align(offset, alignment=8):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _segment_layout(n_exemplars, embedding_dim, text_nbytes):
+    layout = {}
+    offset = _HEADER_SIZE * 8
+    for array_name, dtype, shape in [
+        ("embeddings", np.float32, (n_exemplars, embedding_dim)),
+        ("norms", np.float32, (n_exemplars,)),
+        ("complexity_ranks", np.int8, (n_exemplars,)),
+        ("text_offsets", np.int64, (2 * n_exemplars + 1,)),
+        ("text", np.uint8, (text_nbytes,)),
+    ]:
+        offset = _align(offset)
+        layout[array_name] = (offset, dtype, shape)
+        offset += int(np.prod(shape)) * np.dtype(dtype).itemsize
+    return layout, offset
+
+
+def _segment_name(name, version):
+    return f"{name}_v{version}"
+
+
+def _attach_shared_memory(name):
+    """
+    Attaches to an existing segment without handing its lifetime to this process.
+    Before Python 3.13 the resource tracker would otherwise unlink it when the worker exits.
+    A worker forked from the publisher after its resource tracker started shares that tracker,
+    so unregistering also drops the publisher's registration and the tracker prints a KeyError
+    when the publisher unlinks the segment. The segment is still unlinked correctly.
+    """
+    if sys.version_info >= (3, 13):
+        return shared_memory.SharedMemory(name=name, track=False)
+
+    segment = shared_memory.SharedMemory(name=name)
+    if segment.name not in _published_segment_names:
+        resource_tracker.unregister(segment._name, "shared_memory")
+    return segment
+
+
+def _create_shared_memory(name, size):
+    segment = shared_memory.SharedMemory(name=name, create=True, size=size)
+    _published_segment_names.add(segment.name)
+    return segment
+
+
+def _unlink_shared_memory(segment):
+    segment.close()
+    segment.unlink()
+    _published_segment_names.discard(segment.name)
+
+
+def _views(segment, layout, writeable):
+    """
+    Views are built on the segment's mmap with np.frombuffer, which holds a buffer export,
+    so the segment can't be unmapped (close() raises BufferError) while any view is alive.
+    """
+    views = {}
+    for array_name, (offset, dtype, shape) in layout.items():
+        view = np.frombuffer(
+            segment._mmap, dtype=dtype, count=int(np.prod(shape)), offset=offset
+        ).reshape(shape)
+        view.flags.writeable = writeable
+        views[array_name] = view
+    return views
+
+
+def _header(segment):
+    return np.frombuffer(segment._mmap, dtype=np.int64, count=_HEADER_SIZE)
+
+
+def _control_version(control):
+    return int(np.frombuffer(control._mmap, dtype=np.int64, count=1)[0])
+
+
+def _empty_views():
+    layout, _ = _segment_layout(n_exemplars=0, embedding_dim=0, text_nbytes=0)
+    return {
+        array_name: np.zeros(shape, dtype=dtype)
+        for array_name, (_, dtype, shape) in layout.items()
+    }
+
+
+class SharedExemplarStorePublisher(BaseModel):
+    """
+    Publishes an ExemplarStore into shared memory so worker processes can attach
+    to it with SharedExemplarStore instead of each holding their own copy.
+    Every publish writes a new versioned segment, then atomically bumps the version
+    in a small control segment; the previous segment is unlinked and stays mapped
+    for workers until they refresh.
+    """
+
+    name: str
+    _control: shared_memory.SharedMemory = PrivateAttr(default=None)
+    _segment: shared_memory.SharedMemory = PrivateAttr(default=None)
+    _version: int = PrivateAttr(default=0)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        # Version 0 until the first publish, so workers can attach before then
+        self._create_control()
+
+    def _create_control(self):
+        self._control = _create_shared_memory(self.name, 8)
+        self._write_version(0)
+
+    def _write_version(self, version):
+        # A single aligned 8-byte store, so workers see either the old or the new version
+        control = np.frombuffer(self._control._mmap, dtype=np.int64, count=1)
+        control[0] = version
+
+    def publish(self, exemplar_store: ExemplarStore) -> int:
+        exemplars = exemplar_store.exemplars
+        if exemplars:
+            embeddings = np.array(
+                [example.input_embedding for example in exemplars], dtype=np.float32
+            )
+        else:
+            embeddings = np.zeros((0, 0), dtype=np.float32)
+
+        encoded_texts = []
+        for example in exemplars:
+            encoded_texts += [example.input.encode(), example.label.encode()]
+        text_offsets = np.zeros(2 * len(exemplars) + 1, dtype=np.int64)
+        np.cumsum(
+            [len(text) for text in encoded_texts], dtype=np.int64, out=text_offsets[1:]
+        )
+
+        layout, nbytes = _segment_layout(
+            n_exemplars=embeddings.shape[0],
+            embedding_dim=embeddings.shape[1],
+            text_nbytes=int(text_offsets[-1]),
+        )
+        version = self._version + 1
+        segment = _create_shared_memory(_segment_name(self.name, version), nbytes)
+        header = _header(segment)
+        header[:] = [embeddings.shape[0], embeddings.shape[1], text_offsets[-1], 0]
+        views = _views(segment, layout, writeable=True)
+        views["embeddings"][:] = embeddings
+        views["norms"][:] = np.linalg.norm(embeddings, axis=1)
+        views["complexity_ranks"][:] = [
+            COMPLEXITY_LEVEL_RANKS.get(
+                example.complexity_level, _UNKNOWN_COMPLEXITY_RANK
+            )
+            for example in exemplars
+        ]
+        views["text_offsets"][:] = text_offsets
+        views["text"][:] = np.frombuffer(b"".join(encoded_texts), dtype=np.uint8)
+        del header, views
+
+        if self._control is None:
+            self._create_control()
+        self._write_version(version)
+
+        if self._segment is not None:
+            _unlink_shared_memory(self._segment)
+        self._segment, self._version = segment, version
+        return version
+
+    def close(self):
+        """
+        Unlinks the published segments. Workers already attached keep their mappings.
+        """
+        for segment in [self._segment, self._control]:
+            if segment is not None:
+                _unlink_shared_memory(segment)
+        self._segment, self._control = None, None
+
+
+class SharedExemplarStore(BaseModel):
+    """
+    Read-only, zero-copy view of an ExemplarStore published by SharedExemplarStorePublisher.
+    Call refresh() to pick up a newly published version. Until the first version is
+    published, the store is empty.
+    Each query reads one snapshot of the shared arrays, so refresh() can run while other
+    threads query. A superseded segment stays mapped until no array, including ones
+    returned by `embeddings`, still points into it.
+    Complexity levels other than low / medium / high come back as "unknown".
+    """
+
+    name: str
+    _control: shared_memory.SharedMemory = PrivateAttr(default=None)
+    _segment: shared_memory.SharedMemory = PrivateAttr(default=None)
+    _retired_segments: list = PrivateAttr(default_factory=list)
+    _version: int = PrivateAttr(default=0)
+    _views: dict = PrivateAttr(default_factory=dict)
+
+    def __init__(self, **data):
+        super().__init__(**data)
+        self._views = _empty_views()
+        self.refresh()
+
+    @property
+    def version(self):
+        return self._version
+
+    @property
+    def embeddings(self):
+        return self._views["embeddings"]
+
+    def refresh(self) -> bool:
+        """
+        Attaches to the latest published version. Returns True if it changed.
+        If the latest version has been unlinked without a newer one being published
+        (the publisher was closed), keeps the current version, or raises FileNotFoundError
+        if there is none.
+        """
+        self._close_retired_segments()
+        if self._control is None:
+            try:
+                self._control = _attach_shared_memory(self.name)
+            except FileNotFoundError:
+                # The publisher hasn't been created yet
+                return False
+
+        version = _control_version(self._control)
+        while True:
+            if version == 0 or version == self._version:
+                return False
+            try:
+                segment = _attach_shared_memory(_segment_name(self.name, version))
+                break
+            except FileNotFoundError:
+                latest_version = _control_version(self._control)
+                if latest_version == version:
+                    if self._segment is None:
+                        raise
+                    return False
+                # Superseded by a newer publish while attaching
+                version = latest_version
+
+        n_exemplars, embedding_dim, text_nbytes, _ = _header(segment).tolist()
+        layout, _ = _segment_layout(
+            n_exemplars=n_exemplars,
+            embedding_dim=embedding_dim,
+            text_nbytes=text_nbytes,
+        )
+
+        self._views = _views(segment, layout, writeable=False)
+        if self._segment is not None:
+            self._retired_segments.append(self._segment)
+        self._segment, self._version = segment, version
+        self._close_retired_segments()
+        return True
+
+    def _close_retired_segments(self):
+        # A segment can only be unmapped once no views of it are left
+        still_in_use = []
+        for segment in self._retired_segments:
+            try:
+                segment.close()
+            except BufferError:
+                still_in_use.append(segment)
+        self._retired_segments = still_in_use
+
+    def close(self):
+        self._views = _empty_views()
+        if self._segment is not None:
+            self._retired_segments.append(self._segment)
+            self._segment = None
+        self._close_retired_segments()
+        if self._control is not None:
+            self._control.close()
+            self._control = None
+
+    def size(self):
+        return len(self._views["norms"])
+
+    def get_exemplar(self, i) -> Exemplar:
+        return _get_exemplar(self._views, i)
+
+    @property
+    def exemplars(self) -> list:
+        views = self._views
+        return [_get_exemplar(views, i) for i in range(len(views["norms"]))]
+
+    def estimate_complexity(self, input_text, k=5, input_embedding=None):
+        """
+        Same as ExemplarStore.estimate_complexity, computed on the shared arrays.
+        """
+        views = self._views
+        if len(views["norms"]) == 0:
+            return 0.0
+        if input_embedding is None:
+            input_embedding = get_embedding(input_text)
+        similarities = _cosine_similarities(views, input_embedding)
+        nearest = np.argsort(-similarities)[:k]
+
+        # Unknown complexity levels count as low, like in ExemplarStore
+        max_rank = max(COMPLEXITY_LEVEL_RANKS.values())
+        complexities = np.clip(views["complexity_ranks"][nearest], 0, None) / max_rank
+        weights = np.clip(similarities[nearest], 0, None)
+        if weights.sum() == 0:
+            return float(complexities.mean())
+        return float(np.average(complexities, weights=weights))
+
+    def get_similar_exemplars_to_test_sample(
+        self,
+        input_text,
+        exemplar_selection_method="knn",
+        k=3,
+        prioritise_complex_exemplars=False,
+        diversity=0.0,
+        input_embedding=None,
+    ):
+        """
+        Same as ExemplarStore.get_similar_exemplars_to_test_sample, computed on the shared arrays.
+        """
+        if exemplar_selection_method != "knn":
+            raise NotImplementedError(
+                f"Exemplar selection method {exemplar_selection_method!r} is not supported."
+            )
+
+        views = self._views
+        if len(views["norms"]) == 0:
+            raise ValueError("No exemplars found for KNN search.")
+        if input_embedding is None:
+            input_embedding = get_embedding(input_text)
+        complexity_ranks = views["complexity_ranks"]
+
+        indices_to_search = None
+        if prioritise_complex_exemplars:
+            difficult_indices = np.flatnonzero(
+                complexity_ranks == COMPLEXITY_LEVEL_RANKS["high"]
+            )
+            if len(difficult_indices) >= k:
+                indices_to_search = difficult_indices
+            elif len(difficult_indices) == 0:
+                raise ValueError("No difficult exemplars found.")
+            else:
+                # Use all difficult exemplars and fill the rest with medium and simple ones
+                medium_and_simple_indices = np.flatnonzero(
+                    np.isin(
+                        complexity_ranks,
+                        [
+                            COMPLEXITY_LEVEL_RANKS["medium"],
+                            COMPLEXITY_LEVEL_RANKS["low"],
+                        ],
+                    )
+                )
+                indices_to_search = np.concatenate(
+                    (difficult_indices, medium_and_simple_indices)
+                )
+
+        similarities = _cosine_similarities(views, input_embedding, indices_to_search)
+        if similarities.size == 0:
+            raise ValueError("No exemplars found for KNN search.")
+        if indices_to_search is None:
+            indices_to_search = np.arange(len(views["norms"]))
+
+        # Fetch a larger candidate pool when re-ranking for diversity
+        n_candidates = min(len(similarities), k * 4 if diversity > 0 else k)
+        candidates = np.argsort(-similarities, kind="stable")[:n_candidates]
+        indices = indices_to_search[candidates]
+
+        if diversity > 0:
+            indices = maximal_marginal_relevance(
+                candidate_embeddings=views["embeddings"][indices],
+                query_similarities=similarities[candidates],
+                k=k,
+                diversity=diversity,
+                candidate_indices=indices,
+            )
+
+        return [_get_exemplar(views, int(i)) for i in indices[:k]]
+
+
+def _get_exemplar(views, i) -> Exemplar:
+    text = views["text"]
+    input_start, label_start, label_end = views["text_offsets"][2 * i : 2 * i + 3]
+    return Exemplar(
+        input=text[input_start:label_start].tobytes().decode(),
+        label=text[label_start:label_end].tobytes().decode(),
+        input_embedding=views["embeddings"][i].tolist(),
+        complexity_level=_COMPLEXITY_LEVELS_BY_RANK.get(
+            int(views["complexity_ranks"][i]), "unknown"
+        ),
+    )
+
+
+def _cosine_similarities(views, input_embedding, indices=None):
+    embeddings, norms = views["embeddings"], views["norms"]
+    if indices is not None:
+        embeddings, norms = embeddings[indices], norms[indices]
+    input_embedding = np.asarray(input_embedding, dtype=np.float32)
+    denominators = norms * np.linalg.norm(input_embedding)
+    denominators[denominators == 0] = 1.0
+    return embeddings @ input_embedding / denominators
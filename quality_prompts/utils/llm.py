@@ -1,16 +1,59 @@
-from litellm import completion, embedding
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from litellm import completion, embedding, token_counter
+from pydantic import BaseModel
+
+
+class LLMUsage(BaseModel):
+    llm_calls: int = 0
+    total_tokens: int = 0
+
+    def record(self, response):
+        self.llm_calls += 1
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            self.total_tokens += getattr(usage, "total_tokens", 0) or 0
+
+
+_active_usage_trackers: ContextVar = ContextVar("active_usage_trackers", default=())
+
+
+@contextmanager
+def track_usage():
+    """
+    Counts the LLM / embedding calls and tokens used inside the `with` block.
+    """
+    usage = LLMUsage()
+    token = _active_usage_trackers.set(_active_usage_trackers.get() + (usage,))
+    try:
+        yield usage
+    finally:
+        _active_usage_trackers.reset(token)
+
+
+def _record_usage(response):
+    for usage in _active_usage_trackers.get():
+        usage.record(response)
 
 
 def llm_call(messages, model="gpt-3.5-turbo"):
     response = completion(model=model, messages=messages)
+    _record_usage(response)
     return response.choices[0].message.content
 
 
 def llm_call_multiple_choices(messages, model="gpt-3.5-turbo", n=1, temperature=0):
     response = completion(model=model, messages=messages, n=n, temperature=temperature)
+    _record_usage(response)
     return [choice.message.content for choice in response.choices]
 
 
 def get_embedding(input_text, model="text-embedding-ada-002"):
     response = embedding(model=model, input=[input_text])
+    _record_usage(response)
     return response.data[0]["embedding"]
+
+
+def count_tokens(text, model="gpt-3.5-turbo"):
+    return token_counter(model=model, text=text)
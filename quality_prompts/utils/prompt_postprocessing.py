@@ -1,11 +1,18 @@
 import re
 
+LEADING_WHITESPACE_PATTERN = re.compile(r"^[ \t]+", flags=re.MULTILINE)
+EXTRA_NEW_LINES_PATTERN = re.compile(r"\n{3,}")
 
-def remove_extra_chars(prompt):
+
+def remove_leading_whitespace(prompt):
     # Remove leading tabs and spaces from lines
-    processed_prompt = re.sub(r"^[ \t]+", "", prompt, flags=re.MULTILINE)
+    return LEADING_WHITESPACE_PATTERN.sub("", prompt)
+
 
+def collapse_new_lines(prompt):
     # Replace occurrences of more than two consecutive new lines with exactly two new lines
-    processed_prompt = re.sub(r"\n{3,}", "\n\n", processed_prompt)
+    return EXTRA_NEW_LINES_PATTERN.sub("\n\n", prompt)
 
-    return processed_prompt
+
+def remove_extra_chars(prompt):
+    return collapse_new_lines(remove_leading_whitespace(prompt))